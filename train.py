@@ -2,10 +2,13 @@ import argparse
 import logging
 import os
 import sys
-import math
+import random
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import matplotlib.pyplot as plt
 import torch
 import torch.nn as nn
+import torch.backends.cudnn as cudnn
 import torch.optim.lr_scheduler as lr_scheduler
 from torch import optim
 from torch.utils.tensorboard import SummaryWriter
@@ -15,46 +18,79 @@ from unet import UNet
 from unet import UNet2Plus
 from unet import UNet3Plus, UNet3Plus_DeepSup, UNet3Plus_DeepSup_CGM
 from utils.dataset import BasicDataset
+from utils.dali_loader import get_dali_loader
 from utils.eval import eval_net
+from utils.prefetcher import CUDAPrefetcher
 
 os.environ['KMP_DUPLICATE_LIB_OK'] = 'TRUE'
+# TF32 tensor cores for fp32 matmuls on GPUs without bf16
+torch.set_float32_matmul_precision('high')
 
 dir_img = 'D:\\downloads\\ai\\datasets\\Deep Automatic Portrait Matting\\dataset\\training/imgs/'
 dir_mask = 'D:\\downloads\\ai\\datasets\\Deep Automatic Portrait Matting\\dataset\\training/masks/'
 dir_checkpoint = 'ckpts/'
 
 
-def train_net(unet_type, model, optimizer, device, epochs=5, batch_size=1, lr=0.1, val_percent=0.1, save_cp=True, img_scale=0.5):
+def seed_worker(worker_id):
+    # torch seeds each worker, derive the numpy/random seeds from it
+    worker_seed = torch.initial_seed() % 2**32
+    np.random.seed(worker_seed)
+    random.seed(worker_seed)
+
+
+def log_future_error(future):
+    if future.exception() is not None:
+        logging.error(f'Background task failed: {future.exception()!r}')
+
+
+def train_net(unet_type, model, optimizer, device, epochs=5, batch_size=1, lr=0.1, val_percent=0.1, save_cp=True, img_scale=0.5, amp=False,
+              log_interval=50, dali=False, accum=1):
     dataset = BasicDataset(unet_type, dir_img, dir_mask, img_scale)
     n_val = int(len(dataset) * val_percent)
     n_train = len(dataset) - n_val
 
     train, val = random_split(dataset, [n_train, n_val])
-    train_loader = DataLoader(
-        train, batch_size=batch_size, shuffle=True, num_workers=8, pin_memory=True)
-    val_loader = DataLoader(val, batch_size=batch_size,
-                            shuffle=False, num_workers=8, pin_memory=True)
-
+    mask_type = torch.float32 if model.n_classes == 1 else torch.long
+    if dali:
+        # decode and resize on the GPU instead of in the loader workers
+        device_id = device.index or 0
+        train_loader = get_dali_loader(unet_type, train, img_scale, batch_size, shuffle=True,
+                                       device_id=device_id, mask_type=mask_type)
+        val_loader = get_dali_loader(unet_type, val, img_scale, batch_size, shuffle=False,
+                                     device_id=device_id, mask_type=mask_type)
+    else:
+        # keep the workers alive across epochs and prefetch deeper to hide disk latency
+        num_workers = min(8, os.cpu_count() or 1)
+        train_loader = DataLoader(
+            train, batch_size=batch_size, shuffle=True, num_workers=num_workers, pin_memory=True,
+            persistent_workers=True, prefetch_factor=4, worker_init_fn=seed_worker)
+        val_loader = DataLoader(val, batch_size=batch_size,
+                                shuffle=False, num_workers=num_workers, pin_memory=True,
+                                persistent_workers=True, prefetch_factor=4, worker_init_fn=seed_worker)
+
+    # larger event queue, flushed to disk once a minute
     writer = SummaryWriter(
-        comment=f'LR_{lr}_BS_{batch_size}_SCALE_{img_scale}')
+        comment=f'LR_{lr}_BS_{batch_size}_SCALE_{img_scale}', flush_secs=60, max_queue=1000)
     global_step = 0
 
     logging.info(f'''Starting training:
                      UNet type:       {unet_type}
                      Epochs:          {epochs}
                      Batch size:      {batch_size}
+                     Accumulation:    {accum}
                      Learning rate:   {lr}
                      Dataset size:    {len(dataset)}
                      Training size:   {n_train}
                      Validation size: {n_val}
                      Checkpoints:     {save_cp}
                      Device:          {device.type}
-                     Images scaling:  {img_scale}''')
+                     Images scaling:  {img_scale}
+                     Mixed precision: {amp}
+                     DALI loader:     {dali}''')
 
     # Scheduler https://arxiv.org/pdf/1812.01187.pdf
-    def lf(x): return (((1 + math.cos(x * math.pi / epochs)) / 2)
-                       ** 1.0) * 0.95 + 0.05  # cosine
-    scheduler = lr_scheduler.LambdaLR(optimizer, lr_lambda=lf)
+    # cosine from lr down to 0.05 * lr, no closure so the scheduler state pickles
+    scheduler = lr_scheduler.CosineAnnealingLR(optimizer, T_max=epochs, eta_min=0.05 * lr)
     scheduler.last_epoch = global_step
 
     if model.n_classes > 1:
@@ -62,47 +98,88 @@ def train_net(unet_type, model, optimizer, device, epochs=5, batch_size=1, lr=0.
     else:
         criterion = nn.BCEWithLogitsLoss()
 
+    # mixed precision, bf16 has the fp32 exponent range so it needs no loss scaling.
+    # Native bf16 tensor cores need Ampere (sm_80) or newer, older GPUs use fp16
+    use_bf16 = amp and (device.type != 'cuda' or torch.cuda.get_device_capability(device) >= (8, 0))
+    amp_dtype = torch.bfloat16 if use_bf16 else torch.float16
+    scaler = torch.cuda.amp.GradScaler(enabled=amp and not use_bf16)
+
+    def optimizer_step():
+        scaler.step(optimizer)
+        scaler.update()
+        optimizer.zero_grad(set_to_none=True)
+
+    def log_losses(pending, pbar, epoch_loss):
+        # one device sync for all the queued batch losses
+        steps, losses = zip(*pending)
+        item_losses = torch.stack(losses).float().tolist()
+        for step, item_loss in zip(steps, item_losses):
+            writer.add_scalar('Loss/train', item_loss, step)
+        pending.clear()
+        pbar.set_postfix(**{
+            'loss(batch)': item_losses[-1],
+            'loss(epoch)': epoch_loss.item(),
+            })
+
+    if dali:
+        # DALI already prefetches channels_last batches on the device
+        train_prefetcher = train_loader
+    else:
+        train_prefetcher = CUDAPrefetcher(train_loader, device, mask_type, memory_format=torch.channels_last)
+
+    if save_cp:
+        os.makedirs(dir_checkpoint, exist_ok=True)
+    # checkpoints and tensorboard images are written in the background
+    executor = ThreadPoolExecutor(max_workers=1)
+    save_future = None
+
     lrs = []
     best_loss = 10000
     for epoch in range(epochs):
         cur_lr = optimizer.param_groups[0]['lr']
         print('\nEpoch=', (epoch + 1), ' lr=', cur_lr)
         model.train()
-        epoch_loss = 0
+        # accumulated on the device, batch losses are clamped to 1
+        epoch_loss = torch.zeros((), device=device)
+        pending_losses = []
+        n_accum = 0
 
         with tqdm(total=n_train, desc=f'Epoch {epoch + 1}/{epochs}', unit='img') as pbar:
-            for batch in train_loader:
+            # batches arrive on the device, copied on a side stream
+            for batch in train_prefetcher:
                 imgs = batch['image']
                 true_masks = batch['mask']
 
                 assert imgs.shape[1] == model.n_channels, f'Network has been defined with {model.n_channels} input channels, ' \
                     f'but loaded images have {imgs.shape[1]} channels. Please check that the images are loaded correctly.'
 
-                imgs = imgs.to(device=device, dtype=torch.float32)
-                mask_type = torch.float32 if model.n_classes == 1 else torch.long
-                true_masks = true_masks.to(device=device, dtype=mask_type)
-
                 # with torch.no_grad():
-                masks_pred = model(imgs)
-                loss = criterion(masks_pred, true_masks)
-                item_loss = loss.item()
-                epoch_loss += item_loss if item_loss <= 1 else 1
-                writer.add_scalar('Loss/train', item_loss, global_step)
-                pbar.set_postfix(**{
-                    'loss(batch)': item_loss,
-                    'loss(epoch)': epoch_loss,
-                    })
-
-                optimizer.zero_grad()
-                loss.backward()
-                optimizer.step()
+                with torch.autocast(device.type, dtype=amp_dtype, enabled=amp):
+                    masks_pred = model(imgs)
+                    loss = criterion(masks_pred, true_masks)
+
+                # gradients are accumulated over accum batches before each step
+                scaler.scale(loss / accum).backward()
+                n_accum += 1
+                if n_accum == accum:
+                    optimizer_step()
+                    n_accum = 0
+
+                # keep the loss on the device, it is read every log_interval steps
+                epoch_loss += loss.detach().float().clamp(max=1.0)
+                pending_losses.append((global_step, loss.detach()))
+                if len(pending_losses) == log_interval:
+                    log_losses(pending_losses, pbar, epoch_loss)
 
                 pbar.update(imgs.shape[0])
                 global_step += 1
 
                 # test
                 if global_step % (n_train // 10) == 0:
-                    val_score = eval_net(model, val_loader, device, n_val)
+                    with torch.autocast(device.type, dtype=amp_dtype, enabled=amp):
+                        val_score = eval_net(model, val_loader, device, n_val)
+                    # eval_net leaves the model in eval mode
+                    model.train()
                     if model.n_classes > 1:
                         logging.info('Validation cross entropy: {}'.format(val_score))
                         writer.add_scalar('Loss/test', val_score, global_step)
@@ -110,34 +187,45 @@ def train_net(unet_type, model, optimizer, device, epochs=5, batch_size=1, lr=0.
                         logging.info('Validation Dice Coeff: {}'.format(val_score))
                         writer.add_scalar('Dice/test', val_score, global_step)
 
-                    writer.add_images('images', imgs, global_step)
+                    # first sample only, copied here and encoded off the training thread
+                    images = {'images': imgs[:1].detach().float().cpu()}
                     if model.n_classes == 1:
-                        writer.add_images('masks/true', true_masks, global_step)
-                        writer.add_images('masks/pred', masks_pred, global_step)
+                        images['masks/true'] = true_masks[:1].detach().cpu()
+                        images['masks/pred'] = masks_pred[:1].detach().float().cpu()
+                    for tag, img_tensor in images.items():
+                        future = executor.submit(writer.add_images, tag, img_tensor, global_step)
+                        future.add_done_callback(log_future_error)
+
+            if pending_losses:
+                log_losses(pending_losses, pbar, epoch_loss)
+        # apply a partial window before the scheduler changes the lr
+        if n_accum:
+            optimizer_step()
+        epoch_loss = epoch_loss.item()
 
         # update scheduler
         scheduler.step()
         lrs.append(cur_lr)
 
         if save_cp:
-            try:
-                os.mkdir(dir_checkpoint)
-                logging.info('Created checkpoint directory')
-            except OSError:
-                pass
-
             if epoch_loss < best_loss:
-                save_pt(model, optimizer, f'{dir_checkpoint}/epoch{epoch+1}_{epoch_loss}.pt')
+                # raise here if the previous write failed
+                if save_future is not None:
+                    save_future.result()
+                save_future = save_pt_async(executor, model, optimizer, f'{dir_checkpoint}/epoch{epoch+1}_{epoch_loss}.pt')
                 best_loss = epoch_loss
-                logging.info(f'Checkpoint {epoch + 1} saved ! loss (batch) = {epoch_loss}')
+                logging.info(f'Checkpoint {epoch + 1} queued ! loss (batch) = {epoch_loss}')
 
     # plot lr scheduler
-    plt.plot(lrs, '.-', label='LambdaLR')
+    plt.plot(lrs, '.-', label='CosineAnnealingLR')
     plt.xlabel('epoch')
     plt.ylabel('LR')
     plt.tight_layout()
     plt.savefig('LR.png', dpi=300)
 
+    if save_future is not None:
+        save_future.result()
+    executor.shutdown(wait=True)
     writer.close()
 
 
@@ -153,6 +241,8 @@ def get_args():
                         default=10000, help='Number of epochs', dest='epochs')
     parser.add_argument('-b', '--batch-size', metavar='B', type=int,
                         nargs='?', default=2, help='Batch size', dest='batchsize')
+    parser.add_argument('--accum', metavar='K', type=int, default=1,
+                        help='Number of batches to accumulate gradients over', dest='accum')
     parser.add_argument('-l', '--learning-rate', metavar='LR', type=float,
                         nargs='?', default=0.1, help='Learning rate', dest='lr')
 
@@ -162,7 +252,16 @@ def get_args():
                         default=0.5, help='Downscaling factor of the images')
     parser.add_argument('-v', '--validation', dest='val', type=float, default=10.0,
                         help='Percent of the data that is used as validation (0-100)')
-    return parser.parse_args()
+    parser.add_argument('--amp', dest='amp', action='store_true',
+                        default=False, help='Use mixed precision')
+    parser.add_argument('--compile', dest='compile', action='store_true',
+                        default=False, help='Compile the model with torch.compile')
+    parser.add_argument('--dali', dest='dali', action='store_true',
+                        default=False, help='Load data with NVIDIA DALI on the GPU')
+    args = parser.parse_args()
+    if args.accum < 1:
+        parser.error('--accum must be at least 1')
+    return args
 
 
 def load_pt(model, optimizer, f):
@@ -171,12 +270,34 @@ def load_pt(model, optimizer, f):
     optimizer.load_state_dict(checkpoint['optimizer'])
 
 
-def save_pt(model, optimizer, f):
-    checkpoint = {
+def to_cpu(obj):
+    # copy, training keeps updating the device tensors in place
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {k: to_cpu(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(v) for v in obj)
+    return obj
+
+
+def get_checkpoint(model, optimizer):
+    # unwrap torch.compile so the keys match the plain model
+    model = getattr(model, '_orig_mod', model)
+    return {
         'model': model.state_dict(),
         'optimizer': optimizer.state_dict(),
     }
-    torch.save(checkpoint, f)
+
+
+def save_pt(model, optimizer, f):
+    torch.save(get_checkpoint(model, optimizer), f)
+
+
+def save_pt_async(executor, model, optimizer, f):
+    # snapshot on the training thread, serialize and write on the executor
+    checkpoint = to_cpu(get_checkpoint(model, optimizer))
+    return executor.submit(torch.save, checkpoint, f)
 
 
 if __name__ == '__main__':
@@ -186,6 +307,9 @@ if __name__ == '__main__':
     gpu_id = args.gpu_id
     unet_type = args.unet_type
 
+    # faster convolutions, but more memory; input size is fixed by img_scale
+    cudnn.benchmark = True
+
     os.environ['CUDA_VISIBLE_DEVICES'] = str(gpu_id)
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
     logging.info(f'Using device {device}')
@@ -211,16 +335,24 @@ if __name__ == '__main__':
     # f'\t{'Bilinear' if net.bilinear else 'Dilated conv'} upscaling')
 
     model.to(device=device)
+    # NHWC keeps cuDNN convolutions on the tensor-core kernels
+    model.to(memory_format=torch.channels_last)
+    # fuse the pointwise ops between convolutions, needs PyTorch >= 2.0 with dynamo support.
+    # No CUDA graphs, masks_pred is kept across the eval_net call
+    if args.compile:
+        try:
+            model = torch.compile(model, mode='max-autotune-no-cudagraphs')
+        except (AttributeError, RuntimeError) as e:
+            logging.warning(f'torch.compile is not available, training without it: {e}')
 
+    # multi-tensor update, a few kernel launches instead of one per parameter
     optimizer = optim.RMSprop(
-        model.parameters(), lr=args.lr, weight_decay=1e-8)
-
-    # faster convolutions, but more memory
-    # cudnn.benchmark = True
+        model.parameters(), lr=args.lr, weight_decay=1e-8, foreach=True)
 
     try:
         train_net(unet_type=unet_type, model=model, optimizer=optimizer, epochs=args.epochs, batch_size=args.batchsize,
-                  lr=args.lr, device=device, img_scale=args.scale, val_percent=args.val / 100)
+                  lr=args.lr, device=device, img_scale=args.scale, val_percent=args.val / 100,
+                  amp=args.amp, dali=args.dali, accum=args.accum)
     except KeyboardInterrupt:
         save_pt(model, optimizer, 'INTERRUPTED.pt')
         logging.info('Saved interrupt')
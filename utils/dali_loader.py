@@ -0,0 +1,77 @@
+import math
+
+import torch
+
+try:
+    from nvidia.dali import Pipeline, fn, types
+    from nvidia.dali import math as dmath
+    from nvidia.dali.plugin.pytorch import DALIGenericIterator, LastBatchPolicy
+except ImportError:
+    Pipeline = None
+
+
+def scale_to_unit(data):
+    # like BasicDataset.preprocess, divide by 255 only if the sample has values above 1
+    data = fn.cast(data, dtype=types.FLOAT)
+    needs_scaling = fn.cast(fn.reductions.max(data) > 1.0, dtype=types.FLOAT)
+    return data / (1.0 + needs_scaling * 254.0)
+
+
+def build_pipeline(unet_type, img_files, mask_files, scale, batch_size, shuffle, device_id=0, num_threads=8, seed=42):
+    """Decodes and resizes image/mask pairs on the GPU, same values as BasicDataset.preprocess in HWC layout"""
+    pipe = Pipeline(batch_size=batch_size, num_threads=num_threads, device_id=device_id, seed=seed)
+    with pipe:
+        # both readers shuffle with the same seed, so images and masks stay paired
+        imgs, _ = fn.readers.file(files=img_files, random_shuffle=shuffle, seed=seed, name='imgs')
+        masks, _ = fn.readers.file(files=mask_files, random_shuffle=shuffle, seed=seed, name='masks')
+
+        if unet_type != 'v3':
+            # floor like int(scale * w), fn.resize would round
+            shape = fn.peek_image_shape(imgs)
+            new_w, new_h = dmath.floor(shape[1] * scale), dmath.floor(shape[0] * scale)
+        else:
+            new_w = new_h = int(scale * 640)
+
+        imgs = fn.decoders.image(imgs, device='mixed', output_type=types.RGB)
+        masks = fn.decoders.image(masks, device='mixed', output_type=types.GRAY)
+        imgs = fn.resize(imgs, resize_x=new_w, resize_y=new_h)
+        masks = fn.resize(masks, resize_x=new_w, resize_y=new_h, interp_type=types.INTERP_NN)
+        pipe.set_outputs(scale_to_unit(imgs), scale_to_unit(masks))
+    return pipe
+
+
+class DALILoader:
+    """Iterates a DALI pipeline with the same batch['image']/batch['mask'] dicts as the DataLoader"""
+    def __init__(self, pipe, size, batch_size, mask_type=torch.float32):
+        self.size = size
+        self.batch_size = batch_size
+        self.mask_type = mask_type
+        self.iterator = DALIGenericIterator(pipe, ['image', 'mask'], reader_name='imgs',
+                                            last_batch_policy=LastBatchPolicy.PARTIAL, auto_reset=True)
+
+
+    def __len__(self):
+        return math.ceil(self.size / self.batch_size)
+
+
+    def __iter__(self):
+        for data in self.iterator:
+            # NHWC to NCHW views, i.e. channels_last tensors without a copy
+            batch = data[0]
+            yield {
+                'image': batch['image'].permute(0, 3, 1, 2),
+                'mask': batch['mask'].permute(0, 3, 1, 2).to(dtype=self.mask_type),
+            }
+
+
+def get_dali_loader(unet_type, subset, scale, batch_size, shuffle, device_id=0, num_threads=8, mask_type=torch.float32):
+    """DALI loader over a Subset of BasicDataset as returned by random_split"""
+    assert Pipeline is not None, 'NVIDIA DALI is not installed, see https://docs.nvidia.com/deeplearning/dali'
+    files = [subset.dataset.get_files(i) for i in subset.indices]
+    img_files = [img_file for img_file, _ in files]
+    mask_files = [mask_file for _, mask_file in files]
+
+    pipe = build_pipeline(unet_type, img_files, mask_files, scale, batch_size, shuffle,
+                          device_id=device_id, num_threads=num_threads)
+    pipe.build()
+    return DALILoader(pipe, len(files), batch_size, mask_type)
@@ -47,18 +47,25 @@ class BasicDataset(Dataset):
         img_trans = img_nd.transpose((2, 0, 1))
         if img_trans.max() > 1:
             img_trans = img_trans / 255
-        return img_trans
+        # float32 so the pinned batches copy to the device without a host-side cast
+        return img_trans.astype(np.float32)
 
 
-    def __getitem__(self, i):
+    def get_files(self, i):
         idx = self.ids[i]
         mask_file = glob(self.masks_dir + idx + '*')
         img_file = glob(self.imgs_dir + idx + '*')
 
         assert len(mask_file) == 1, f'Either no mask or multiple masks found for the ID {idx}: {mask_file}'
         assert len(img_file) == 1, f'Either no image or multiple images found for the ID {idx}: {img_file}'
-        mask = Image.open(mask_file[0])
-        img = Image.open(img_file[0])
+        return img_file[0], mask_file[0]
+
+
+    def __getitem__(self, i):
+        idx = self.ids[i]
+        img_file, mask_file = self.get_files(i)
+        mask = Image.open(mask_file)
+        img = Image.open(img_file)
 
         assert img.size == mask.size, f'Image and mask {idx} should be the same size, but are {img.size} and {mask.size}'
         img = self.preprocess(self.unet_type, img, self.scale)
@@ -5,6 +5,7 @@ from loss.diceLoss import dice_coeff
 from loss.bceLoss import BCE_loss
 
 
+@torch.inference_mode()
 def eval_net(net, loader, device, n_val):
     """Evaluation without the densecrf with the dice coefficient"""
     net.eval()
@@ -15,10 +16,10 @@ def eval_net(net, loader, device, n_val):
             imgs = batch['image']
             true_masks = batch['mask']
 
-            # with torch.no_grad():
-            imgs = imgs.to(device=device, dtype=torch.float32)
+            imgs = imgs.to(device=device, dtype=torch.float32, non_blocking=True, memory_format=torch.channels_last)
             mask_type = torch.float32 if net.n_classes == 1 else torch.long
-            true_masks = true_masks.to(device=device, dtype=mask_type)
+            # cast on the device, a cast in the copy would run on the host
+            true_masks = true_masks.to(device=device, non_blocking=True).to(dtype=mask_type)
             mask_pred = net(imgs)
             for true_mask, pred in zip(true_masks, mask_pred):
                 pred = (pred > 0.5).float()
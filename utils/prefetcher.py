@@ -0,0 +1,58 @@
+import torch
+
+
+class CUDAPrefetcher:
+    """Copies batch N+1 to the device on a side stream while batch N trains"""
+    def __init__(self, loader, device, mask_type=torch.float32, memory_format=torch.contiguous_format):
+        self.loader = loader
+        self.device = device
+        self.mask_type = mask_type
+        self.memory_format = memory_format
+
+
+    def __len__(self):
+        return len(self.loader)
+
+
+    def _to_device(self, batch):
+        # plain copy of the pinned batch first, dtype and layout are converted on the device.
+        # A dtype change inside the copy would cast on the host and block
+        imgs = batch['image'].to(device=self.device, non_blocking=True)
+        masks = batch['mask'].to(device=self.device, non_blocking=True)
+        return {
+            'image': imgs.to(dtype=torch.float32, memory_format=self.memory_format),
+            'mask': masks.to(dtype=self.mask_type, memory_format=self.memory_format),
+        }
+
+
+    def _preload(self, it, stream):
+        batch = next(it, None)
+        if batch is None:
+            return None
+
+        with torch.cuda.stream(stream):
+            batch = self._to_device(batch)
+            event = torch.cuda.Event()
+            event.record(stream)
+        return batch, event
+
+
+    def __iter__(self):
+        if self.device.type != 'cuda':
+            for batch in self.loader:
+                yield self._to_device(batch)
+            return
+
+        stream = torch.cuda.Stream(device=self.device)
+        it = iter(self.loader)
+        loaded = self._preload(it, stream)
+        while loaded is not None:
+            batch, event = loaded
+            current = torch.cuda.current_stream(self.device)
+            current.wait_event(event)
+            # tensors were allocated on the copy stream but are consumed on this one
+            for t in batch.values():
+                t.record_stream(current)
+
+            loaded = self._preload(it, stream)
+            yield batch